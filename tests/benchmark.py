@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+'''
+Benchmarks for the node server's hot paths: rule compilation and
+evaluation, DateProvider refresh and rollover, Controller.refresh, and the
+latency of commands, configuration changes and rollovers driven through
+the udi_interface stub, checked against LIMITS.
+
+Runs offline against the udi_interface stub and writes the results as JSON
+so runs from different versions can be compared:
+
+    python3 tests/benchmark.py --output bench_output.json
+'''
+from datetime import date
+from datetime import timedelta
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import click
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS))
+sys.path.insert(0, TESTS)
+
+import polyglot_stub  # noqa: E402
+
+polyglot_stub.install()
+
+import holidays_server  # noqa: E402
+from holidays_server import Controller  # noqa: E402
+from holidays_server import DateProvider  # noqa: E402
+from holidays_server import PARSE_CACHE  # noqa: E402
+from holidays_server import ParseCache  # noqa: E402
+from holidays_server import Rule  # noqa: E402
+
+BASE = date(2024, 3, 1)
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July',
+          'August', 'September', 'October', 'November', 'December']
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday']
+
+# Latency budgets, in seconds, of what the node server is driven with;
+# means over them are flagged in the report
+LIMITS = {
+    'harness_command': 0.005,
+    'harness_config': 0.05,
+    'harness_rollover': 0.1
+}
+
+
+def generate_rules(count):
+    '''
+        Returns count (description, rule string) pairs cycling through every
+        supported rule form, with varying dates so most fragments differ.
+    '''
+    rules = []
+    for i in range(0, count):
+        month = MONTHS[i % 12]
+        day = i % 28 + 1
+        form = i % 5
+        if form == 0:
+            rule = 'every {} {}'.format(month, day)
+        elif form == 1:
+            rule = 'every {}th of the month'.format(day)
+        elif form == 2:
+            rule = 'every {} from {} 1 to {} 28'.format(
+                WEEKDAYS[i % 5], month, MONTHS[(i + 3) % 12])
+        elif form == 3:
+            rule = '{} {} {}'.format(month, day, 2024 + i % 3)
+        else:
+            rule = 'every {} {} to December 31 2030'.format(month, day)
+        rules.append(('Rule {}'.format(i), rule))
+    return rules
+
+
+def measure(fn, repeat, setup=None):
+    times = []
+    for i in range(0, repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {
+        'min': min(times),
+        'mean': sum(times) / len(times),
+        'max': max(times),
+        'repeat': repeat
+    }
+
+
+def make_provider(country, rules, horizon=366):
+    provider = DateProvider(country, horizon=horizon)
+    provider.get_now = lambda: BASE
+    for desc, rule in rules:
+        provider.add_custom_rule(rule, desc)
+    provider.refresh()
+    provider.build_occurrences()
+    return provider
+
+
+def bench_rules(count, repeat):
+    rules = generate_rules(count)
+    results = []
+
+    def compile_rules():
+        for desc, rule in rules:
+            Rule(rule, desc).compile()
+
+    # before/after pinning the rule language: dateparser auto-detecting
+    # the language over all its locales against the long-lived parsers
+    PARSE_CACHE.set_languages(None)
+    result = measure(compile_rules, repeat, PARSE_CACHE.clear)
+    result['per_rule'] = result['mean'] / count
+    results.append(('rule_compile_autodetect', {'rules': count}, result))
+    PARSE_CACHE.set_languages(ParseCache.DEFAULT_LANGUAGES)
+
+    result = measure(compile_rules, repeat, PARSE_CACHE.clear)
+    result['per_rule'] = result['mean'] / count
+    results.append(('rule_compile_cold', {'rules': count}, result))
+    results.append(('rule_compile_cached', {'rules': count},
+                    measure(compile_rules, repeat)))
+
+    compiled = [Rule(rule, desc) for desc, rule in rules]
+    for rule in compiled:
+        rule.compile()
+
+    def evaluate():
+        for rule in compiled:
+            rule.parse(BASE)
+
+    results.append(('rule_evaluate', {'rules': count},
+                    measure(evaluate, repeat)))
+    return results
+
+
+def bench_provider(country, count, repeat):
+    rules = generate_rules(count)
+    params = {'country': country, 'rules': count}
+    provider = make_provider(country, rules)
+    results = []
+
+    def rebuild():
+        # drop the index so that this times a full rebuild, which an
+        # unchanged set_weekend no longer forces
+        with provider.update():
+            provider.index = None
+            provider.refresh()
+        provider.build_occurrences()
+
+    results.append(('provider_refresh', params, measure(rebuild, repeat)))
+
+    days = iter(range(1, repeat + 1))
+
+    def rollover():
+        day = BASE + timedelta(next(days))
+        provider.get_now = lambda: day
+        provider.refresh()
+        provider.build_occurrences()
+
+    results.append(('provider_rollover', params, measure(rollover, repeat)))
+
+    def lookups():
+        for i in range(0, 366):
+            provider.is_date_off(BASE + timedelta(i))
+
+    results.append(('provider_lookup_year', params, measure(lookups, repeat)))
+    return results
+
+
+def bench_controller(count, lookahead, repeat, cache_dir):
+    poly = polyglot_stub.Interface()
+    controller = Controller(poly, 'controller', 'controller', 'Controller')
+    controller.holidayCache.path = os.path.join(cache_dir,
+                                                'holidays_cache.json')
+    controller.customData.load({'customDates': {}})
+    controller.discover()
+    controller.parameterHandler({
+        'country': 'US',
+        'includeHolidays': [],
+        'excludeHolidays': [],
+        'weekend': ['Saturday', 'Sunday'],
+        'lookahead': lookahead,
+        'rules': [{
+            'description': desc,
+            'dateStr': rule
+        } for desc, rule in generate_rules(count)]
+    })
+    params = {'rules': count, 'lookahead': lookahead}
+    results = []
+
+    sent = len(poly.messages)
+    result = measure(controller.refresh, repeat)
+    result['messages'] = (len(poly.messages) - sent) / repeat
+    results.append(('controller_refresh', params, result))
+
+    def change():
+        controller.dateProvider.set_weekend(['Sunday'])
+        controller.refresh()
+        controller.dateProvider.set_weekend(['Saturday', 'Sunday'])
+        controller.refresh()
+
+    sent = len(poly.messages)
+    result = measure(change, repeat)
+    result['messages'] = (len(poly.messages) - sent) / repeat
+    results.append(('controller_refresh_changed', params, result))
+    controller.worker.stop()
+    return results
+
+
+def bench_harness(repeat):
+    '''
+        Drives a Controller through the polyglot stub: day node commands,
+        configuration changes and midnight rollovers, timed per call.
+    '''
+    params = {
+        'country': 'US',
+        'includeHolidays': [],
+        'excludeHolidays': [],
+        'weekend': ['Saturday', 'Sunday'],
+        'rules': [{
+            'description': 'Casual',
+            'dateStr': 'every friday'
+        }]
+    }
+    harness = polyglot_stub.Harness(params, today=BASE)
+    harness.start()
+    try:
+        for i in range(0, 100 * repeat):
+            harness.command('thursday', 'DON' if i % 2 else 'DOF')
+        harness.flush()
+        for i in range(0, 10 * repeat):
+            harness.configure(dict(params, weekend=['Sunday'] if i %
+                                   2 else ['Saturday', 'Sunday']))
+        for i in range(0, 10 * repeat):
+            harness.midnight()
+        summary = harness.summary()
+    finally:
+        harness.stop()
+
+    results = []
+    for kind in ('command', 'config', 'rollover'):
+        name = 'harness_' + kind
+        result = dict(summary[kind], limit=LIMITS[name])
+        results.append((name, {}, result))
+    return results
+
+
+def run(rule_counts, countries, lookaheads, repeat):
+    results = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for count in rule_counts:
+            results.extend(bench_rules(count, repeat))
+            for country in countries:
+                results.extend(bench_provider(country, count, repeat))
+            for lookahead in lookaheads:
+                results.extend(
+                    bench_controller(count, lookahead, repeat, cache_dir))
+        results.extend(bench_harness(repeat))
+
+    import dateparser
+    import holidays
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'dateparser': dateparser.__version__,
+            'holidays': holidays.__version__,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': [{
+            'name': name,
+            'params': params,
+            'seconds': result
+        } for name, params, result in results]
+    }
+
+
+@click.command()
+@click.option('--output', default='bench_output.json',
+              help='File to write the JSON results to')
+@click.option('--repeat', default=3, help='Runs per measurement')
+@click.option('--rules', 'rule_counts', multiple=True, type=int,
+              default=[1, 10, 100, 1000], help='Rule set sizes')
+@click.option('--country', 'countries', multiple=True,
+              default=['US', 'GB', 'DE', 'JP'], help='Countries')
+@click.option('--lookahead', 'lookaheads', multiple=True, type=int,
+              default=[7, 90], help='Day node lookahead sizes')
+def benchmark(output, repeat, rule_counts, countries, lookaheads):
+    report = run(rule_counts, countries, lookaheads, repeat)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for result in report['results']:
+        seconds = result['seconds']
+        over = seconds['mean'] > seconds.get('limit', seconds['mean'])
+        click.echo('{:<28} {:<40} {:10.2f} ms{}'.format(
+            result['name'], json.dumps(result['params']),
+            seconds['mean'] * 1000,
+            '  over {:.2f} ms limit'.format(seconds['limit'] * 1000)
+            if over else ''))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,276 @@
+'''
+Minimal in-process stand-in for udi_interface, so the node server can be
+imported and driven without Polyglot or an ISY.
+
+Interface can be handed to the node server's nodes whether or not the real
+udi_interface is installed. When it is not, install() must be called before
+holidays_server is imported. Harness builds a Controller on top of it and
+drives commands, config changes and rollovers while recording latencies.
+'''
+from collections import Counter
+from collections import OrderedDict
+from copy import deepcopy
+from datetime import date
+from datetime import timedelta
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+LOGGER = logging.getLogger('udi_interface')
+
+
+class Node(object):
+
+    def __init__(self, poly, primary, address, name):
+        self.poly = poly
+        self.primary = primary
+        self.address = address
+        self.name = name
+        self.drivers = deepcopy(self.drivers)
+        for drv in poly.db_getNodeDrivers(address):
+            for d in self.drivers:
+                if d['driver'] == drv['driver']:
+                    d['value'] = drv['value']
+
+    def getDriver(self, driver):
+        for d in self.drivers:
+            if d['driver'] == driver:
+                return d['value']
+        return None
+
+    def setDriver(self, driver, value, report=True, force=False, uom=None,
+                  text=None):
+        for d in self.drivers:
+            if d['driver'] == driver:
+                changed = d['value'] != value
+                d['value'] = value
+                if report and (changed or force):
+                    self.reportDriver(driver, force)
+                return changed
+        return False
+
+    def reportDriver(self, driver, force):
+        for d in self.drivers:
+            if d['driver'] == driver:
+                self.poly.send({'set': [dict(d, address=self.address,
+                                             value=str(d['value']))]},
+                               'status')
+
+    def reportDrivers(self):
+        self.poly.send({
+            'set': [dict(d, address=self.address) for d in self.drivers]
+        }, 'status')
+
+    def query(self):
+        self.reportDrivers()
+
+    def runCmd(self, command):
+        self.commands[command['cmd']](self, command)
+
+    def start(self):
+        pass
+
+    id = ''
+    commands = {}
+    drivers = []
+
+
+class Custom(dict):
+
+    def __init__(self, poly, custom):
+        self.__dict__['poly'] = poly
+        self.__dict__['custom'] = custom
+        self.__dict__['_rawdata'] = {}
+
+    def load(self, new_data, save=False):
+        self.__dict__['_rawdata'] = new_data if new_data is not None else {}
+        if save:
+            self._save()
+
+    def _save(self):
+        self.poly.send({
+            'set': [{
+                'key': self.__dict__['custom'],
+                'value': self.__dict__['_rawdata']
+            }]
+        }, 'custom')
+
+    def __getattr__(self, key):
+        return self.__dict__['_rawdata'].get(key)
+
+    def __getitem__(self, key):
+        return self.__dict__['_rawdata'].get(key)
+
+    def __setitem__(self, key, value):
+        self.__dict__['_rawdata'][key] = value
+        self._save()
+
+
+class Interface(object):
+
+    START = 'start'
+    STOP = 'stop'
+    POLL = 'poll'
+    CUSTOMTYPEDPARAMS = 'customtypedparams'
+    CUSTOMTYPEDDATA = 'customtypeddata'
+
+    def __init__(self, classes=None, options=None):
+        self.messages = []
+        self.counts = Counter()
+        self.subscribers = {}
+        self._nodes = OrderedDict()
+        self.customParamsDoc = None
+        self.started = False
+
+    def subscribe(self, topic, callback, address=None):
+        self.subscribers.setdefault(topic, []).append((callback, address))
+
+    def publish(self, topic, address=None, *args):
+        for callback, subscribed in list(self.subscribers.get(topic, [])):
+            if subscribed is None or subscribed == address:
+                callback(*args)
+
+    def send(self, message, type):
+        self.messages.append((type, message))
+        self.counts[type] += 1
+        if type == 'status':
+            self.counts['drivers'] += len(message.get('set', ()))
+
+    def addNode(self, node, conn_status=None, rename=False):
+        self._nodes[node.address] = node
+        if self.started:
+            self.publish(self.START, node.address)
+        return node
+
+    def delNode(self, address):
+        self._nodes.pop(address, None)
+
+    def getNode(self, address):
+        return self._nodes.get(address)
+
+    def nodes(self):
+        return list(self._nodes.values())
+
+    def db_getNodeDrivers(self, address):
+        return []
+
+    def getMarkDownData(self, fileName):
+        return ''
+
+    def setCustomParamsDoc(self, data):
+        self.customParamsDoc = data
+
+    def start(self, version=None):
+        pass
+
+    def ready(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def updateProfile(self):
+        pass
+
+    def runForever(self):
+        pass
+
+
+class Harness(object):
+    '''
+        Runs the node server's Controller against an Interface, with a
+        controllable current date, and times what it is asked to drive.
+    '''
+
+    def __init__(self, params=None, customDates=None, today=None):
+        import holidays_server
+        self.server = holidays_server
+        self.today = today or date.today()
+        self.latencies = {}
+        self.tmp = tempfile.mkdtemp()
+
+        harness = self
+
+        class ClockDate(date):
+            @classmethod
+            def today(cls):
+                return harness.today
+
+        self.realDate = holidays_server.date
+        holidays_server.date = ClockDate
+
+        self.poly = Interface()
+        self.controller = holidays_server.Controller(self.poly, 'controller',
+                                                     'controller',
+                                                     'Holiday Controller')
+        self.controller.holidayCache.path = os.path.join(
+            self.tmp, 'holidays_cache.json')
+        self.controller.customData.load({'customDates': customDates or {}})
+        if params is not None:
+            self.configure(params)
+
+    def timed(self, kind, fn, *args):
+        start = time.perf_counter()
+        result = fn(*args)
+        self.latencies.setdefault(kind, []).append(time.perf_counter() -
+                                                   start)
+        return result
+
+    def start(self):
+        self.poly.started = True
+        self.timed('start', self.poly.publish, Interface.START, 'controller')
+
+    def stop(self):
+        self.poly.publish(Interface.STOP)
+        self.server.date = self.realDate
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def configure(self, params):
+        self.timed('config', self.poly.publish, Interface.CUSTOMTYPEDDATA,
+                   None, params)
+
+    def command(self, address, cmd):
+        node = self.poly.getNode(address)
+        self.timed('command', node.runCmd, {'address': address, 'cmd': cmd})
+
+    def poll(self, flag='longPoll'):
+        self.timed('poll', self.poly.publish, Interface.POLL, None, flag)
+
+    def midnight(self):
+        self.today += timedelta(1)
+        self.timed('rollover', self.controller.rollover, self.today)
+
+    def flush(self):
+        self.controller.customDatesWriter.flush()
+        self.controller.worker.join()
+
+    def day_nodes(self):
+        return [node for node in self.poly.nodes()
+                if isinstance(node, self.server.DayNode)]
+
+    def summary(self):
+        result = {}
+        for kind, times in self.latencies.items():
+            ordered = sorted(times)
+            result[kind] = {
+                'count': len(times),
+                'mean': sum(times) / len(times),
+                'p95': ordered[min(len(ordered) - 1,
+                                   int(len(ordered) * 0.95))],
+                'max': ordered[-1]
+            }
+        return result
+
+
+def install():
+    module = types.ModuleType('udi_interface')
+    module.LOGGER = LOGGER
+    module.Node = Node
+    module.Custom = Custom
+    module.Interface = Interface
+    sys.modules['udi_interface'] = module
+    return module
@@ -0,0 +1,35 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+
+
+class BenchmarkTester(unittest.TestCase):
+
+    def test_smoke(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'bench.json')
+            subprocess.check_call([
+                sys.executable,
+                os.path.join(TESTS, 'benchmark.py'), '--output', output,
+                '--repeat', '1', '--rules', '10', '--country', 'US',
+                '--lookahead', '7'
+            ], cwd=tmp, stdout=subprocess.DEVNULL)
+            with open(output) as f:
+                report = json.load(f)
+
+        names = set(result['name'] for result in report['results'])
+        self.assertIn('rule_compile_cold', names)
+        self.assertIn('rule_compile_autodetect', names)
+        self.assertIn('provider_rollover', names)
+        self.assertIn('controller_refresh', names)
+        self.assertIn('harness_command', names)
+        self.assertIn('holidays', report['meta'])
+
+
+if __name__ == '__main__':
+    unittest.main()
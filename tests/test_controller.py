@@ -0,0 +1,475 @@
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+import os
+import threading
+import time
+import udi_interface
+import sys
+import unittest
+from unittest.mock import Mock
+from unittest.mock import patch
+
+from holidays_server import Controller
+from holidays_server import DateProvider
+from holidays_server import DayNode
+from holidays_server import DebouncedWriter
+from holidays_server import INSTRUMENTATION
+from holidays_server import Instrumentation
+from holidays_server import MidnightScheduler
+from holidays_server import Worker
+from holidays_server import decode_custom_dates
+from holidays_server import encode_custom_dates
+
+sys.stdout = sys.__stdout__
+sys.stderr = sys.__stderr__
+udi_interface.LOGGER.handlers = []
+
+
+def make_controller():
+    poly = Mock()
+    poly.db_getNodeDrivers.return_value = []
+    poly.nodes.return_value = []
+    controller = Controller(poly, 'controller', 'controller', 'Controller')
+    controller.customData.load({'customDates': {}})
+    controller.discover()
+    return poly, controller
+
+
+class WorkerTester(unittest.TestCase):
+
+    def test_order(self):
+        worker = Worker()
+        result = []
+        for i in range(0, 5):
+            worker.submit(result.append, i)
+        worker.join()
+        worker.stop()
+
+        self.assertEqual(result, [0, 1, 2, 3, 4])
+
+    def test_error_isolated(self):
+        worker = Worker()
+        result = []
+        worker.submit(lambda: 1 / 0)
+        worker.submit(result.append, 1)
+        worker.join()
+        worker.stop()
+
+        self.assertEqual(result, [1])
+
+
+class DebouncedWriterTester(unittest.TestCase):
+
+    def test_coalesce(self):
+        worker = Worker()
+        write = Mock()
+        writer = DebouncedWriter(write, worker, delay=0.05)
+        for i in range(0, 5):
+            writer.submit(i)
+        time.sleep(0.2)
+        worker.join()
+        worker.stop()
+
+        write.assert_called_once_with(4)
+        self.assertEqual(writer.saved, 4)
+
+    def test_flush(self):
+        write = Mock()
+        writer = DebouncedWriter(write, Worker(), delay=60)
+        writer.submit({})
+        writer.flush()
+        writer.flush()
+
+        write.assert_called_once_with({})
+        self.assertIsNone(writer.timer)
+
+    def test_flush_waits_for_write(self):
+        started = threading.Event()
+        release = threading.Event()
+        written = []
+
+        def write(value):
+            if value == 'old':
+                started.set()
+                release.wait(5)
+            written.append(value)
+
+        writer = DebouncedWriter(write, Worker(), delay=60)
+        writer.submit('old')
+        background = threading.Thread(target=writer.flush)
+        background.start()
+        started.wait(5)
+        writer.submit('new')
+        final = threading.Thread(target=writer.flush)
+        final.start()
+        time.sleep(0.05)
+        release.set()
+        background.join(5)
+        final.join(5)
+
+        self.assertEqual(written, ['old', 'new'])
+
+
+class MidnightSchedulerTester(unittest.TestCase):
+
+    def test_next_midnight(self):
+        self.assertEqual(
+            MidnightScheduler.next_midnight(datetime(2018, 12, 31, 23, 59)),
+            datetime(2019, 1, 1))
+
+    def test_dst(self):
+        tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'America/New_York'
+        time.tzset()
+        try:
+            now = datetime(2018, 11, 4, 0, 30)
+            self.assertEqual(
+                MidnightScheduler.seconds_until(
+                    MidnightScheduler.next_midnight(now), now), 24.5 * 3600)
+            now = datetime(2018, 3, 11, 0, 30)
+            self.assertEqual(
+                MidnightScheduler.seconds_until(
+                    MidnightScheduler.next_midnight(now), now), 22.5 * 3600)
+        finally:
+            if tz is None:
+                os.environ.pop('TZ')
+            else:
+                os.environ['TZ'] = tz
+            time.tzset()
+
+    def test_prepare_then_rollover(self):
+        events = []
+        done = threading.Event()
+        target = datetime.now() + timedelta(seconds=0.3)
+        scheduler = MidnightScheduler(
+            lambda day: (events.append('rollover'), done.set()),
+            lambda day: events.append('prepare'),
+            lead=0.2)
+
+        with patch.object(MidnightScheduler, 'next_midnight',
+                          side_effect=[target, datetime.now() + timedelta(1)]):
+            scheduler.start()
+            self.assertTrue(done.wait(5))
+            scheduler.stop()
+
+        self.assertEqual(events, ['prepare', 'rollover'])
+        self.assertGreaterEqual(datetime.now(), target)
+
+
+class ControllerCommandTester(unittest.TestCase):
+
+    def test_command_does_not_wait_for_save(self):
+        poly, controller = make_controller()
+        node = [c.args[0] for c in poly.addNode.call_args_list
+                if isinstance(c.args[0], DayNode)][0]
+        release = threading.Event()
+        save = Mock(side_effect=lambda dates: release.wait(5))
+        controller.customDatesWriter.write = save
+
+        start = time.monotonic()
+        node.set_on(None)
+        elapsed = time.monotonic() - start
+        release.set()
+        controller.customDatesWriter.flush()
+
+        self.assertLess(elapsed, 0.5)
+        self.assertEqual(node.getDriver('ST'), 1)
+        save.assert_called_once_with(
+            {str(node.dateProvider.dates[node.key]): True})
+        controller.worker.stop()
+
+    def test_saved_in_background(self):
+        poly, controller = make_controller()
+        today = date.today()
+        controller.set_on(today)
+        controller.set_force_off(today)
+        time.sleep(controller.customDatesWriter.delay + 0.2)
+        controller.worker.join()
+
+        self.assertEqual(controller.customData['customDates'],
+                         {str(today): False})
+        self.assertEqual(controller.customDatesWriter.written, 1)
+        self.assertFalse(controller.dateProvider.is_date_off(today))
+        controller.worker.stop()
+
+    def test_stop(self):
+        poly, controller = make_controller()
+        controller.set_on(date.today())
+        controller.stop()
+
+        self.assertEqual(controller.customData['customDates'],
+                         {str(date.today()): True})
+        poly.stop.assert_called_once_with()
+
+
+class LookaheadTester(unittest.TestCase):
+
+    def test_discover(self):
+        poly, controller = make_controller()
+        controller.dateProvider.set_lookahead(30)
+        poly.addNode.reset_mock()
+        controller.discover()
+
+        nodes = [c.args[0] for c in poly.addNode.call_args_list]
+        self.assertEqual(len(nodes), 2 + 30)
+        self.assertEqual(nodes[-1].address, 'day29')
+        self.assertEqual(controller.dateProvider.dates['Day29'],
+                         date.today() + timedelta(29))
+        controller.worker.stop()
+
+    def test_shrink(self):
+        poly, controller = make_controller()
+        controller.dateProvider.set_lookahead(10)
+        controller.discover()
+        poly.nodes.return_value = [
+            c.args[0] for c in poly.addNode.call_args_list
+            if isinstance(c.args[0], DayNode)
+        ]
+        controller.dateProvider.set_lookahead(9)
+        controller.discover()
+
+        poly.delNode.assert_called_once_with('day9')
+        controller.worker.stop()
+
+    def test_limits(self):
+        poly, controller = make_controller()
+        controller.dateProvider.set_lookahead(1000)
+        self.assertEqual(controller.dateProvider.lookahead, 90)
+        controller.dateProvider.set_lookahead(1)
+        self.assertEqual(controller.dateProvider.lookahead, 7)
+        controller.worker.stop()
+
+
+class InstrumentationTester(unittest.TestCase):
+
+    def test_disabled(self):
+        stats = Instrumentation()
+        fn = stats.timed('fn')(lambda x: x + 1)
+
+        self.assertEqual(fn(1), 2)
+        self.assertEqual(stats.get('fn')['count'], 0)
+
+    def test_enabled(self):
+        stats = Instrumentation(enabled=True)
+        fn = stats.timed('fn')(lambda: time.sleep(0.01))
+        fn()
+        fn()
+
+        timing = stats.get('fn')
+        self.assertEqual(timing['count'], 2)
+        self.assertGreaterEqual(timing['max'], 0.01)
+        self.assertGreaterEqual(timing['total'], timing['last'])
+        self.assertIn('fn n=2', stats.summary())
+
+    def test_controller_drivers(self):
+        poly, controller = make_controller()
+        INSTRUMENTATION.reset()
+        INSTRUMENTATION.enabled = True
+        try:
+            controller.refresh()
+            controller.poll('longPoll')
+        finally:
+            INSTRUMENTATION.enabled = False
+
+        self.assertEqual(INSTRUMENTATION.get('controller.refresh')['count'],
+                         1)
+        self.assertEqual(INSTRUMENTATION.get('provider.refresh')['count'], 1)
+        self.assertEqual(INSTRUMENTATION.get('daynode.refresh')['count'], 0)
+        self.assertEqual(
+            controller.getDriver('GV3'),
+            int(round(INSTRUMENTATION.get('controller.refresh')['last'] *
+                      1000)))
+        controller.worker.stop()
+
+
+class LongPollTester(unittest.TestCase):
+
+    def test_missed_rollover(self):
+        poly, controller = make_controller()
+        with patch.object(controller, 'rollover') as rollover:
+            controller.poll('longPoll')
+            rollover.assert_not_called()
+
+            controller.currentDate = date.today() - timedelta(1)
+            with self.assertLogs(udi_interface.LOGGER, 'WARNING'):
+                controller.poll('longPoll')
+            rollover.assert_called_once_with(date.today())
+        controller.worker.stop()
+
+    def test_rollover_serialized(self):
+        poly, controller = make_controller()
+        poly.getMarkDownData.return_value = ''
+        tomorrow = date.today() + timedelta(1)
+        with controller.lock:
+            thread = threading.Thread(target=controller.rollover,
+                                      args=(tomorrow,))
+            thread.start()
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+        thread.join(5)
+        self.assertEqual(controller.currentDate, tomorrow)
+
+        with patch.object(controller, 'refresh') as refresh:
+            controller.rollover(tomorrow)
+        refresh.assert_not_called()
+        controller.worker.stop()
+
+
+class ParameterHandlerTester(unittest.TestCase):
+
+    PARAMS = {
+        'country': 'US',
+        'includeHolidays': [],
+        'excludeHolidays': [],
+        'weekend': ['Saturday', 'Sunday'],
+        'rules': [{'description': 'Casual', 'dateStr': 'every friday'}]
+    }
+
+    def test_incremental(self):
+        poly, controller = make_controller()
+        controller.parameterHandler(dict(self.PARAMS))
+        poly.nodes.return_value = [
+            c.args[0] for c in poly.addNode.call_args_list
+            if isinstance(c.args[0], DayNode)
+        ]
+        controller.update_nodes()
+        index = controller.dateProvider.index
+        poly.send.reset_mock()
+
+        with patch.object(controller.dateProvider, 'refresh') as refresh:
+            controller.parameterHandler(dict(self.PARAMS))
+            poly.send.assert_not_called()
+
+            controller.parameterHandler(
+                dict(self.PARAMS, weekend=['Sunday']))
+            refresh.assert_not_called()
+
+        self.assertIs(controller.dateProvider.index, index)
+        changes = [change for c in poly.send.call_args_list
+                   for change in c.args[0]['set']]
+        saturdays = {
+            node.address for node in poly.nodes.return_value
+            if controller.dateProvider.dates[node.key].weekday() == 5
+        }
+        self.assertEqual({change['address'] for change in changes},
+                         saturdays | {'controller'})
+        controller.worker.stop()
+
+
+    def test_commands_not_blocked(self):
+        poly, controller = make_controller()
+        compiling = threading.Event()
+        release = threading.Event()
+
+        def compileAll(rules):
+            compiling.set()
+            release.wait(5)
+            for rule in rules:
+                rule.compile()
+
+        with patch('holidays_server.Rule.compileAll', compileAll):
+            handler = threading.Thread(
+                target=controller.parameterHandler,
+                args=(dict(self.PARAMS, rules=[
+                    {'description': 'Gym', 'dateStr': 'every tuesday'}]),))
+            handler.start()
+            compiling.wait(5)
+            command = threading.Thread(target=controller.set_on,
+                                       args=(date.today() + timedelta(3),))
+            command.start()
+            command.join(2)
+            blocked = command.is_alive()
+            release.set()
+            handler.join(5)
+            command.join(5)
+
+        self.assertFalse(blocked)
+        self.assertEqual(
+            [rule.desc for rule in controller.dateProvider.custom_rules],
+            ['Gym'])
+        controller.worker.stop()
+
+    def test_known_holidays(self):
+        poly, controller = make_controller()
+        poly.getMarkDownData.return_value = ''
+        controller.addHolidaysList()
+        controller.addHolidaysList()
+
+        poly.setCustomParamsDoc.assert_called_once()
+        self.assertIn('<li>Independence Day</li>',
+                      poly.setCustomParamsDoc.call_args.args[0])
+        controller.worker.stop()
+
+    def test_unknown_names(self):
+        poly, controller = make_controller()
+        with self.assertLogs(udi_interface.LOGGER, 'WARNING') as logs:
+            controller.parameterHandler(
+                dict(self.PARAMS, excludeHolidays=['Independance Day']))
+
+        self.assertIn('Independance Day', logs.output[0])
+        controller.worker.stop()
+
+    def test_invalid_lookahead(self):
+        poly, controller = make_controller()
+        with self.assertLogs(udi_interface.LOGGER, 'WARNING'):
+            controller.parameterHandler(
+                dict(self.PARAMS, lookahead='two weeks',
+                     weekend=['Sunday']))
+
+        self.assertEqual(controller.dateProvider.lookahead,
+                         DateProvider.MIN_LOOKAHEAD)
+        self.assertEqual(controller.dateProvider.weekend_days, {6})
+        controller.worker.stop()
+
+    def test_invalid_retention(self):
+        poly, controller = make_controller()
+        with self.assertLogs(udi_interface.LOGGER, 'WARNING'):
+            controller.parameterHandler(
+                dict(self.PARAMS, customDatesRetention='two weeks'))
+        self.assertEqual(controller.retention, Controller.DEFAULT_RETENTION)
+        self.assertEqual(controller.dateProvider.weekend_days, {5, 6})
+
+        with self.assertLogs(udi_interface.LOGGER, 'WARNING'):
+            controller.parameterHandler(
+                dict(self.PARAMS, customDatesRetention='-5'))
+        self.assertEqual(controller.retention, 0)
+        controller.worker.stop()
+
+
+class CustomDatesTester(unittest.TestCase):
+
+    def test_encode_ranges(self):
+        dates = {date(2018, 7, 1) + timedelta(i): True for i in range(0, 14)}
+        dates[date(2018, 7, 15)] = False
+        dates[date(2018, 7, 20)] = True
+
+        encoded = encode_custom_dates(dates)
+        self.assertEqual(encoded, {
+            '2018-07-01/2018-07-14': True,
+            '2018-07-15': False,
+            '2018-07-20': True
+        })
+        self.assertEqual(decode_custom_dates(encoded), dates)
+
+    def test_decode_legacy(self):
+        self.assertEqual(decode_custom_dates({'2018-07-04': False}),
+                         {date(2018, 7, 4): False})
+        self.assertEqual(decode_custom_dates(None), {})
+
+    def test_prune(self):
+        poly, controller = make_controller()
+        today = date.today()
+        controller.retention = 7
+        controller.set_on(today - timedelta(10))
+        controller.set_on(today - timedelta(3))
+        controller.prune_custom_dates()
+        controller.customDatesWriter.flush()
+
+        self.assertEqual(controller.customData['customDates'],
+                         {str(today - timedelta(3)): True})
+        controller.worker.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,22 @@
 from datetime import date
+import json
+import os
+import tempfile
+import threading
 import udi_interface
 import sys
 import unittest
 from unittest.mock import Mock
+from unittest.mock import patch
 
+from holidays_server import CalendarSource
 from holidays_server import DateProvider
+from holidays_server import HolidayCache
+from holidays_server import HolidayTable
+from holidays_server import NameIndex
 from holidays_server import Rule
+from holidays_server import holiday_keys
+from holidays_server import is_listed
 
 sys.stdout = sys.__stdout__
 sys.stderr = sys.__stderr__
@@ -91,5 +102,438 @@ class DateProviderTester(unittest.TestCase):
 
         self.assertFalse(provider.is_holiday('Wednesday'))
 
+    def test_index_lookup(self):
+        provider = DateProvider(horizon=30)
+        provider.get_now = Mock(return_value=date(2018, 7, 1))
+        provider.refresh()
+        provider.build_index()
+        provider.holidays = Mock()
+
+        self.assertEqual(len(provider.index), 30)
+        self.assertEqual(provider.get_flags(date(2018, 7, 4)),
+                         DateProvider.HOLIDAY)
+        self.assertEqual(provider.get_flags(date(2018, 7, 7)),
+                         DateProvider.WEEKEND)
+        self.assertEqual(provider.get_flags(date(2018, 7, 5)), 0)
+        provider.holidays.get.assert_not_called()
+
+    def test_outside_index(self):
+        provider = DateProvider(horizon=30)
+        provider.get_now = Mock(return_value=date(2018, 7, 1))
+        provider.refresh()
+
+        self.assertTrue(provider.is_date_off(date(2018, 12, 25)))
+        self.assertFalse(provider.is_date_off(date(2018, 12, 27)))
+
+    def test_custom_dates(self):
+        provider = DateProvider()
+        provider.get_now = Mock(return_value=date(2018, 7, 1))
+        provider.refresh()
+        provider.set_custom_dates({
+            date(2018, 7, 2): True,
+            date(2018, 7, 4): False
+        })
+
+        self.assertTrue(provider.is_day_off('Monday'))
+        self.assertFalse(provider.is_day_off('Wednesday'))
+
+        provider.set_custom_date(date(2018, 7, 4), None)
+        self.assertTrue(provider.is_day_off('Wednesday'))
+
+    def test_rollover(self):
+        provider = DateProvider(horizon=60)
+        provider.add_custom_rule('every friday', 'Casual')
+        provider.get_now = Mock(return_value=date(2018, 6, 28))
+        provider.refresh()
+        provider.build_index()
+        table = provider.holidays
+
+        for day in range(29, 31):
+            provider.get_now = Mock(return_value=date(2018, 6, day))
+            provider.refresh()
+        rolled = bytes(provider.index)
+
+        provider.build_index()
+        self.assertIs(provider.holidays, table)
+        self.assertEqual(provider.index_start, date(2018, 6, 30).toordinal())
+        self.assertEqual(rolled, bytes(provider.index))
+        self.assertTrue(provider.is_date_off(date(2018, 6, 29)))
+        self.assertTrue(provider.is_date_off(date(2018, 7, 6)))
+        self.assertFalse(provider.is_date_off(date(2018, 7, 5)))
+
+    def test_rule_occurrences(self):
+        provider = DateProvider(horizon=90)
+        provider.get_now = Mock(return_value=date(2018, 7, 1))
+        provider.set_custom_rules([
+            ('every 15th of the month', 'Payday'),
+            ('every friday to August 31st 2018', 'Casual')
+        ])
+        provider.refresh()
+
+        self.assertEqual(provider.count_days_off(date(2018, 8, 13),
+                                                 date(2018, 8, 18)), 2)
+        self.assertEqual(provider.holiday_name(date(2018, 9, 15)), 'Payday')
+        self.assertEqual(provider.next_holiday(date(2018, 9, 1)),
+                         (date(2018, 9, 3), 'Labor Day'))
+        self.assertFalse(provider.is_date_off(date(2018, 9, 7)))
+        self.assertTrue(provider.is_date_off(date(2019, 1, 15)))
+
+    def test_rollover_rule_change(self):
+        provider = DateProvider()
+        provider.get_now = Mock(return_value=date(2018, 7, 1))
+        provider.refresh()
+        provider.build_index()
+
+        provider.add_custom_rule('every tuesday', 'Gym')
+        provider.refresh()
+
+        self.assertIsNotNone(provider.index)
+        self.assertTrue(provider.is_holiday('Tuesday'))
+
+
+class IncrementalConfigTester(unittest.TestCase):
+
+    def setUp(self):
+        self.provider = DateProvider(horizon=60)
+        self.provider.get_now = Mock(return_value=date(2018, 7, 1))
+        self.provider.set_custom_rules([('every friday', 'Casual')])
+        self.provider.refresh()
+        self.provider.build_index()
+
+    def assertIndexRebuilt(self):
+        patched = bytes(self.provider.index)
+        self.provider.build_index()
+        self.assertEqual(patched, bytes(self.provider.index))
+
+    def test_include_exclude(self):
+        index = self.provider.index
+        self.provider.set_exclude(['Independence Day', 'Casual'])
+
+        self.assertIs(self.provider.index, index)
+        self.assertFalse(self.provider.is_holiday('Wednesday'))
+        self.assertFalse(self.provider.is_holiday('Friday'))
+        self.assertIndexRebuilt()
+
+        self.provider.set_exclude([])
+        self.provider.set_include(['Independence Day'])
+        self.assertTrue(self.provider.is_holiday('Wednesday'))
+        self.assertIndexRebuilt()
+
+    def test_weekend(self):
+        index = self.provider.index
+        self.provider.set_weekend(['Friday'])
+
+        self.assertIs(self.provider.index, index)
+        self.assertTrue(self.provider.is_weekend('Friday'))
+        self.assertFalse(self.provider.is_weekend('Sunday'))
+        self.assertIndexRebuilt()
+
+    def test_rules(self):
+        casual = self.provider.custom_rules[0]
+        with patch('holidays_server.Rule.compileRule',
+                   wraps=Rule.compileRule) as compileRule:
+            self.provider.set_custom_rules([('every friday', 'Casual'),
+                                            ('every tuesday', 'Gym')])
+
+        compileRule.assert_called_once_with('every tuesday')
+        self.assertIs(self.provider.custom_rules[0], casual)
+        self.assertTrue(self.provider.is_holiday('Tuesday'))
+        self.assertIndexRebuilt()
+
+        self.provider.set_custom_rules([('every tuesday', 'Gym')])
+        self.assertFalse(self.provider.is_holiday('Friday'))
+        self.assertIndexRebuilt()
+
+
+class SnapshotTester(unittest.TestCase):
+
+    def setUp(self):
+        self.provider = DateProvider(horizon=60)
+        self.provider.get_now = Mock(return_value=date(2018, 7, 1))
+        self.provider.refresh()
+
+    def test_swap(self):
+        snapshot = self.provider.current()
+        self.provider.set_exclude(['Independence Day'])
+
+        self.assertIsNot(self.provider.current(), snapshot)
+        self.assertTrue(snapshot.get_flags(date(2018, 7, 4)) &
+                        DateProvider.HOLIDAY)
+        self.assertFalse(self.provider.is_holiday('Wednesday'))
+        with self.assertRaises(TypeError):
+            snapshot.dates['today'] = date(2018, 7, 2)
+
+    def test_grouped(self):
+        snapshot = self.provider.current()
+        with self.provider.update():
+            self.provider.set_weekend(['Friday'])
+            self.provider.set_exclude(['Independence Day'])
+            self.assertIs(self.provider.current(), snapshot)
+
+        self.assertTrue(self.provider.is_weekend('Friday'))
+        self.assertFalse(self.provider.is_holiday('Wednesday'))
+
+    def test_readers_do_not_block(self):
+        self.provider.current()
+        result = []
+        with self.provider.lock:
+            reader = threading.Thread(
+                target=lambda: result.append(
+                    self.provider.is_day_off('Wednesday')))
+            reader.start()
+            reader.join(1)
+
+        self.assertEqual(result, [True])
+
+
+class NameIndexTester(unittest.TestCase):
+
+    def setUp(self):
+        self.provider = DateProvider(horizon=60)
+        self.provider.get_now = Mock(return_value=date(2021, 7, 1))
+        self.provider.refresh()
+
+    def test_keys(self):
+        self.assertEqual(holiday_keys('Christmas Day (Observed)'),
+                         {'christmas day'})
+        self.assertEqual(holiday_keys(' Christmas Day;  Boxing Day'),
+                         {'christmas day', 'boxing day'})
+        self.assertTrue(is_listed('Christmas Day; Boxing Day',
+                                  frozenset(['boxing day']), frozenset()))
+        self.assertFalse(is_listed('Christmas Day; Boxing Day', frozenset(),
+                                   frozenset(['boxing day',
+                                              'christmas day'])))
+        self.assertEqual(holiday_keys('Eid al-Adha (observed, estimated)'),
+                         {'eid al-adha'})
+        self.assertEqual(
+            holiday_keys(
+                'Dia de Portugal, de Camões e das Comunidades Portuguesas'),
+            {'dia de portugal, de camões e das comunidades portuguesas'})
+
+    def test_names_with_commas(self):
+        provider = DateProvider('PT')
+
+        self.assertIn('Dia de Portugal, de Camões e das Comunidades '
+                      'Portuguesas', provider.get_holiday_list())
+        self.assertNotIn('de Camões e das Comunidades Portuguesas',
+                         provider.get_holiday_list())
+
+    def test_legacy_delimiter(self):
+        import holidays.constants
+        table = {date(2018, 12, 25): 'Christmas Day, Family Day'}
+        with patch.object(holidays.constants, 'HOLIDAY_NAME_DELIMITER', ', '):
+            table = HolidayTable.join_names(table)
+
+        self.assertEqual(table, {date(2018, 12, 25):
+                                 'Christmas Day; Family Day'})
+        self.assertEqual(holiday_keys(table[date(2018, 12, 25)]),
+                         {'christmas day', 'family day'})
+
+    def test_observed_estimated(self):
+        provider = DateProvider('CM')
+        provider.get_now = Mock(return_value=date(2024, 1, 1))
+        provider.refresh()
+        observed = [
+            dt for dt, name in provider.holidays.year(2024).items()
+            if name == 'Eid al-Adha (observed, estimated)'
+        ]
+        self.assertTrue(observed)
+        self.assertIn('Eid al-Adha', provider.get_holiday_list())
+
+        provider.set_exclude(['Eid al-Adha'])
+        self.assertIsNone(provider.holiday_name(observed[0]))
+
+    def test_index(self):
+        index = NameIndex()
+        index.add(date(2021, 12, 25), 'Christmas Day')
+        index.add(date(2021, 12, 27), 'Christmas Day (observed); Boxing Day')
+
+        self.assertEqual(list(index.names.values()),
+                         ['Christmas Day', 'Boxing Day'])
+        self.assertEqual(index.lookup(['christmas day']),
+                         {date(2021, 12, 25), date(2021, 12, 27)})
+
+    def test_observed(self):
+        self.assertTrue(self.provider.is_date_off(date(2021, 7, 5)))
+        self.provider.set_exclude(['independence day'])
+
+        self.assertFalse(self.provider.is_date_off(date(2021, 7, 5)))
+        self.assertEqual(self.provider.holiday_name(date(2021, 7, 5)), None)
+
+    def test_holiday_list(self):
+        names = self.provider.get_holiday_list()
+
+        self.assertIn('Independence Day', names)
+        self.assertEqual(len(names), len(set(names)))
+        self.assertFalse([name for name in names if 'observed' in name])
+
+    def test_unknown_names(self):
+        self.provider.set_custom_rules([('every friday', 'Casual')])
+
+        self.assertEqual(
+            self.provider.unknown_names([
+                'Independance Day', 'christmas day (Observed)', 'Casual', ''
+            ]), ['Independance Day'])
+
+
+class RangeQueryTester(unittest.TestCase):
+
+    def setUp(self):
+        self.provider = DateProvider(horizon=60)
+        self.provider.add_custom_rule('July 20th 2018', 'Vacation')
+        self.provider.get_now = Mock(return_value=date(2018, 7, 2))
+        self.provider.refresh()
+
+    def test_next_day_off(self):
+        self.assertEqual(self.provider.next_day_off(date(2018, 7, 2)),
+                         date(2018, 7, 4))
+        self.assertEqual(self.provider.next_day_off(date(2018, 7, 5)),
+                         date(2018, 7, 7))
+        self.assertIsNone(self.provider.next_day_off(date(2018, 12, 1)))
+
+    def test_next_holiday(self):
+        self.assertEqual(self.provider.next_holiday(date(2018, 7, 2)),
+                         (date(2018, 7, 4), 'Independence Day'))
+        self.assertEqual(self.provider.next_holiday(date(2018, 7, 5)),
+                         (date(2018, 7, 20), 'Vacation'))
+
+    def test_working_days(self):
+        self.assertEqual(
+            self.provider.count_working_days(date(2018, 7, 2),
+                                             date(2018, 7, 9)), 4)
+        self.assertEqual(
+            self.provider.count_working_days(date(2018, 7, 16),
+                                             date(2018, 7, 23)), 4)
+
+    def test_working_days_outside_index(self):
+        self.assertEqual(
+            self.provider.count_working_days(date(2018, 6, 25),
+                                             date(2018, 7, 9)), 9)
+        self.assertEqual(
+            self.provider.count_working_days(date(2018, 12, 24),
+                                             date(2018, 12, 31)), 4)
+
+    def test_custom_override(self):
+        self.provider.next_day_off(date(2018, 7, 2))
+        self.provider.set_custom_date(date(2018, 7, 3), True)
+        self.provider.set_custom_date(date(2018, 7, 4), False)
+
+        self.assertEqual(self.provider.next_day_off(date(2018, 7, 2)),
+                         date(2018, 7, 3))
+        self.assertEqual(
+            self.provider.count_working_days(date(2018, 7, 2),
+                                             date(2018, 7, 9)), 4)
+
+    def test_rollover(self):
+        self.provider.next_day_off(date(2018, 7, 2))
+        self.provider.get_now = Mock(return_value=date(2018, 7, 5))
+        self.provider.refresh()
+
+        self.assertEqual(self.provider.next_day_off(date(2018, 7, 5)),
+                         date(2018, 7, 7))
+
+
+class CalendarSourceTester(unittest.TestCase):
+
+    def setUp(self):
+        self.provider = DateProvider()
+        self.provider.get_now = Mock(return_value=date(2018, 7, 1))
+        self.provider.refresh()
+
+    def test_merged(self):
+        self.provider.set_calendars([
+            CalendarSource('US'),
+            CalendarSource('CA', 'ON'),
+            CalendarSource('US', 'CA')
+        ])
+
+        self.assertTrue(self.provider.is_date_off(date(2018, 3, 30)))
+        self.assertTrue(self.provider.is_date_off(date(2018, 11, 23)))
+        self.assertFalse(self.provider.is_date_off(date(2018, 7, 3)))
+        self.assertEqual(self.provider.holiday_name(date(2018, 7, 4)),
+                         'Independence Day')
+        self.assertEqual(self.provider.next_holiday(date(2018, 7, 1)),
+                         (date(2018, 7, 1), 'Canada Day'))
+
+    def test_per_source_filter(self):
+        self.provider.set_calendars([
+            CalendarSource('US', exclude=['Independence Day']),
+            CalendarSource('CA', include=['Christmas Day'])
+        ])
+
+        self.assertFalse(self.provider.is_holiday('Wednesday'))
+        self.assertFalse(self.provider.is_holiday('Monday'))
+        self.assertTrue(self.provider.is_date_off(date(2018, 12, 25)))
+
+    def test_tables_kept(self):
+        self.provider.set_calendars(
+            [CalendarSource('US'), CalendarSource('CA')])
+        table = self.provider.tables[('CA', None)]
+        table.year(2018)
+
+        self.provider.set_calendars(
+            [CalendarSource('US'), CalendarSource('CA'), CalendarSource('GB')])
+        self.provider.set_country('DE')
+
+        self.assertIs(self.provider.tables[('CA', None)], table)
+        self.assertNotIn(('US', None), self.provider.tables)
+        self.assertEqual(self.provider.country, 'DE')
+
+
+    def test_invalid_dropped(self):
+        provider = DateProvider()
+        provider.get_now = Mock(return_value=date(2018, 7, 1))
+        provider.refresh()
+        sources = provider.set_calendars([
+            CalendarSource('US'),
+            CalendarSource('US', 'XX'),
+            CalendarSource('CA', 'ON')
+        ])
+
+        self.assertEqual(sources,
+                         [CalendarSource('US'), CalendarSource('CA', 'ON')])
+        self.assertTrue(provider.is_day_off('today'))
+
+    def test_invalid_primary_kept(self):
+        provider = DateProvider('US')
+        provider.set_calendars([CalendarSource('XX')])
+
+        self.assertEqual(provider.sources, [CalendarSource('US')])
+        self.assertEqual(provider.country, 'US')
+        provider.is_day_off('today')
+
+
+class HolidayCacheTester(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        os.remove(self.path)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_round_trip(self):
+        table = HolidayTable('US', cache=HolidayCache(self.path))
+        self.assertEqual(table.get(date(2018, 7, 4)), 'Independence Day')
+
+        with patch('holidays.country_holidays') as expand:
+            table = HolidayTable('US', cache=HolidayCache(self.path))
+            self.assertEqual(table.get(date(2018, 7, 4)), 'Independence Day')
+        expand.assert_not_called()
+
+    def test_version_mismatch(self):
+        with open(self.path, 'w') as f:
+            json.dump({
+                'version': '0.0.0',
+                'tables': {'US||2018': {'2018-07-05': 'Stale Day'}}
+            }, f)
+
+        table = HolidayTable('US', cache=HolidayCache(self.path))
+        self.assertIsNone(table.get(date(2018, 7, 5)))
+        self.assertEqual(table.get(date(2018, 7, 4)), 'Independence Day')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,85 @@
+from datetime import date
+import udi_interface
+import sys
+import unittest
+from unittest.mock import Mock
+from unittest.mock import patch
+
+from holidays_server import DateProvider
+from holidays_server import DayNode
+from holidays_server import DRIVER_STATS
+
+sys.stdout = sys.__stdout__
+sys.stderr = sys.__stderr__
+udi_interface.LOGGER.handlers = []
+
+
+class DayNodeTester(unittest.TestCase):
+
+    def setUp(self):
+        self.poly = Mock()
+        self.poly.db_getNodeDrivers.return_value = []
+        self.provider = DateProvider()
+        self.provider.get_now = Mock(return_value=date(2018, 7, 1))
+        self.provider.refresh()
+        self.node = DayNode(self.poly, 'controller', 'wednesday',
+                            'Wednesday Day Node', 'Wednesday', self.provider,
+                            Mock(), False, False)
+
+    def sent(self):
+        return [c.args[0]['set'] for c in self.poly.send.call_args_list]
+
+    def test_batched(self):
+        self.node.refresh()
+
+        self.assertEqual(self.poly.send.call_count, 1)
+        self.assertEqual([(d['driver'], d['value']) for d in self.sent()[0]],
+                         [('GV0', '7'), ('GV1', '4'), ('GV2', '2018'),
+                          ('ST', '1')])
+
+    def test_unchanged(self):
+        self.node.refresh()
+        suppressed = DRIVER_STATS.suppressed
+        self.node.refresh()
+
+        self.assertEqual(self.poly.send.call_count, 1)
+        self.assertEqual(DRIVER_STATS.suppressed, suppressed + 4)
+
+    def test_changed_only(self):
+        self.node.refresh()
+        self.provider.set_exclude(['Independence Day'])
+        self.node.refresh()
+
+        self.assertEqual(self.poly.send.call_count, 2)
+        self.assertEqual([(d['driver'], d['value']) for d in self.sent()[1]],
+                         [('ST', '0')])
+
+    def test_single_snapshot(self):
+        snapshot = self.provider.current()
+        # a rollover published after the node took its snapshot
+        self.provider.get_now.return_value = date(2018, 7, 5)
+        self.provider.refresh()
+        with patch.object(self.provider, 'current', return_value=snapshot):
+            self.node.refresh()
+
+        self.assertEqual([(d['driver'], d['value']) for d in self.sent()[0]],
+                         [('GV0', '7'), ('GV1', '4'), ('GV2', '2018'),
+                          ('ST', '1')])
+
+    def test_batch_for_caller(self):
+        changes = self.node.refresh(report=False)
+
+        self.poly.send.assert_not_called()
+        self.assertEqual(len(changes), 4)
+        self.assertEqual(self.node.getDriver('ST'), 1)
+
+    def test_report_drivers(self):
+        self.node.refresh()
+        self.node.reportDrivers()
+        self.node.refresh()
+
+        self.assertEqual(self.poly.send.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+from datetime import date
+import udi_interface
+import sys
+import unittest
+
+from polyglot_stub import Harness
+
+sys.stdout = sys.__stdout__
+sys.stderr = sys.__stderr__
+udi_interface.LOGGER.handlers = []
+
+PARAMS = {
+    'country': 'US',
+    'includeHolidays': [],
+    'excludeHolidays': [],
+    'weekend': ['Saturday', 'Sunday'],
+    'rules': [{
+        'description': 'Casual',
+        'dateStr': 'every friday'
+    }]
+}
+
+
+class HarnessTester(unittest.TestCase):
+
+    def setUp(self):
+        self.harness = Harness(PARAMS, today=date(2018, 7, 2))
+        self.harness.start()
+
+    def tearDown(self):
+        self.harness.stop()
+
+    def test_start(self):
+        nodes = self.harness.day_nodes()
+
+        self.assertEqual(len(nodes), 9)
+        today = self.harness.poly.getNode('today')
+        self.assertEqual(today.getDriver('GV1'), 2)
+        self.assertEqual(self.harness.poly.getNode('wednesday').getDriver('ST'),
+                         1)
+        self.assertEqual(self.harness.controller.getDriver('ST'), 1)
+
+    def test_commands_coalesced(self):
+        # no debounced write may fire before the flush
+        self.harness.controller.customDatesWriter.delay = 60
+        customData = self.harness.poly.counts['custom']
+        for i in range(0, 1000):
+            self.harness.command('thursday', 'DON' if i % 2 else 'DOF')
+        self.harness.flush()
+
+        self.assertEqual(self.harness.summary()['command']['count'], 1000)
+        self.assertEqual(self.harness.poly.getNode('thursday').getDriver('ST'),
+                         1)
+        self.assertEqual(self.harness.poly.counts['custom'] - customData, 1)
+        self.assertEqual(self.harness.controller.customData['customDates'],
+                         {'2018-07-05': True})
+
+    def test_config_changes(self):
+        for i in range(0, 50):
+            self.harness.configure(dict(PARAMS, weekend=['Sunday'] if i %
+                                        2 else ['Saturday', 'Sunday']))
+
+        self.assertEqual(self.harness.poly.getNode('saturday').getDriver('ST'),
+                         0)
+
+    def test_rollovers(self):
+        for i in range(0, 30):
+            sent = self.harness.poly.counts['status']
+            self.harness.midnight()
+            # one batch for the day nodes, the rest are controller drivers
+            self.assertLessEqual(self.harness.poly.counts['status'] - sent, 4)
+
+        today = self.harness.poly.getNode('today')
+        self.assertEqual(today.getDriver('GV1'), 1)
+        self.assertEqual(today.getDriver('GV0'), 8)
+        friday = self.harness.poly.getNode('friday')
+        self.assertEqual(friday.getDriver('GV1'), 3)
+        self.assertEqual(friday.getDriver('ST'), 1)
+
+    def test_prune_on_rollover(self):
+        self.harness.command('today', 'DON')
+        for i in range(0, 31):
+            self.harness.midnight()
+        self.harness.flush()
+
+        self.assertEqual(self.harness.controller.customData['customDates'],
+                         {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+from datetime import date
+import os
+import tempfile
+import time
+import udi_interface
+import sys
+import unittest
+from unittest.mock import Mock
+from unittest.mock import patch
+
+from holidays_server import DateProvider
+from holidays_server import IcsCalendar
+
+sys.stdout = sys.__stdout__
+sys.stderr = sys.__stderr__
+udi_interface.LOGGER.handlers = []
+
+ICS = '''BEGIN:VCALENDAR
+VERSION:2.0
+BEGIN:VTIMEZONE
+TZID:America/New_York
+BEGIN:STANDARD
+DTSTART:19701101T020000
+END:STANDARD
+END:VTIMEZONE
+BEGIN:VEVENT
+SUMMARY:Teacher
+  Workday
+DTSTART;VALUE=DATE:20180710
+DTEND;VALUE=DATE:20180711
+END:VEVENT
+BEGIN:VEVENT
+SUMMARY:Summer Break
+DTSTART;VALUE=DATE:20180716
+DTEND;VALUE=DATE:20180721
+BEGIN:VALARM
+ACTION:DISPLAY
+SUMMARY:Not an event
+TRIGGER:-PT15M
+END:VALARM
+END:VEVENT
+BEGIN:VEVENT
+SUMMARY:Half Day\\, Early Release
+DTSTART;TZID=America/New_York:20180703T080000
+DTEND;TZID=America/New_York:20180703T120000
+RRULE:FREQ=WEEKLY;UNTIL=20180731T000000Z
+EXDATE;TZID=America/New_York:20180717T080000
+END:VEVENT
+END:VCALENDAR
+'''
+
+
+class IcsCalendarTester(unittest.TestCase):
+
+    def setUp(self):
+        IcsCalendar.CACHE.clear()
+
+    def test_parse(self):
+        events = IcsCalendar.parse(ICS.splitlines(True))
+
+        self.assertEqual(len(events), 3)
+        self.assertEqual(events[0].summary, 'Teacher Workday')
+        self.assertEqual(events[1].days, 5)
+        self.assertEqual(events[2].summary, 'Half Day, Early Release')
+        self.assertEqual(events[2].exdates, frozenset([date(2018, 7, 17)]))
+
+    def test_invalid_rule_skipped(self):
+        ics = ICS.replace('RRULE:FREQ=WEEKLY', 'RRULE:FREQ=FORTNIGHTLY')
+        with self.assertLogs(udi_interface.LOGGER, 'WARNING'):
+            calendar = IcsCalendar.load(data=ics)
+
+        self.assertEqual(len(calendar.events), 2)
+        self.assertEqual(calendar.get(date(2018, 7, 10)), ['Teacher Workday'])
+
+    @unittest.skipUnless(hasattr(time, 'tzset'), 'requires time.tzset')
+    def test_utc_times(self):
+        tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'America/New_York'
+        time.tzset()
+        try:
+            events = IcsCalendar.parse([
+                'BEGIN:VEVENT\n', 'SUMMARY:Late\n',
+                'DTSTART:20180704T020000Z\n', 'END:VEVENT\n'])
+        finally:
+            if tz is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = tz
+            time.tzset()
+
+        self.assertEqual(events[0].start, date(2018, 7, 3))
+        self.assertEqual(events[0].time.hour, 22)
+
+    def test_expand(self):
+        calendar = IcsCalendar.load(data=ICS)
+        days = sorted(calendar.year(2018))
+
+        self.assertEqual(days, [
+            date(2018, 7, 3), date(2018, 7, 10), date(2018, 7, 16),
+            date(2018, 7, 17), date(2018, 7, 18), date(2018, 7, 19),
+            date(2018, 7, 20), date(2018, 7, 24)
+        ])
+        self.assertEqual(calendar.get(date(2018, 7, 17)), ['Summer Break'])
+
+    def test_cached_by_hash(self):
+        fd, path = tempfile.mkstemp(suffix='.ics')
+        with os.fdopen(fd, 'w') as f:
+            f.write(ICS)
+        try:
+            first = IcsCalendar.load(path=path)
+            with patch.object(IcsCalendar, 'parse') as parse:
+                second = IcsCalendar.load(path=path)
+                third = IcsCalendar.load(data=ICS)
+            parse.assert_not_called()
+        finally:
+            os.remove(path)
+
+        self.assertIs(first, second)
+        self.assertIs(first, third)
+
+    def test_cache_bounded(self):
+        first = IcsCalendar.load(data=ICS)
+        with patch.object(IcsCalendar, 'CACHE_SIZE', 2):
+            for i in range(0, 3):
+                # an edited file has a new hash
+                IcsCalendar.load(data=ICS.replace('Teacher', str(i)))
+
+        self.assertEqual(len(IcsCalendar.CACHE), 2)
+        self.assertIsNot(IcsCalendar.load(data=ICS), first)
+
+    def test_provider(self):
+        provider = DateProvider()
+        provider.get_now = Mock(return_value=date(2018, 7, 2))
+        provider.refresh()
+        provider.set_imported([IcsCalendar.load(data=ICS)])
+
+        self.assertTrue(provider.is_holiday('Tuesday'))
+        self.assertTrue(provider.is_date_off(date(2018, 7, 18)))
+        self.assertFalse(provider.is_date_off(date(2018, 7, 11)))
+        self.assertEqual(provider.holiday_name(date(2018, 7, 10)),
+                         'Teacher Workday, Half Day, Early Release')
+
+        provider.set_exclude(['Summer Break'])
+        self.assertFalse(provider.is_date_off(date(2018, 7, 18)))
+
+    def test_many_events(self):
+        lines = ['BEGIN:VCALENDAR']
+        for i in range(0, 500):
+            lines.extend([
+                'BEGIN:VEVENT', 'SUMMARY:Event {}'.format(i),
+                'DTSTART;VALUE=DATE:2018{:02d}{:02d}'.format(
+                    i % 12 + 1, i % 28 + 1), 'END:VEVENT'
+            ])
+        lines.append('END:VCALENDAR')
+
+        with patch('dateparser.parse') as parse:
+            calendar = IcsCalendar.load(data='\r\n'.join(lines))
+            calendar.year(2018)
+        parse.assert_not_called()
+        self.assertEqual(len(calendar.events), 500)
+        self.assertEqual(len(calendar.year(2018)), 84)
+
+
+if __name__ == '__main__':
+    unittest.main()
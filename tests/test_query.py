@@ -0,0 +1,121 @@
+from datetime import date
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import udi_interface
+import unittest
+
+from holidays_server import describe_date
+from holidays_server import load_provider
+
+sys.stdout = sys.__stdout__
+sys.stderr = sys.__stderr__
+udi_interface.LOGGER.handlers = []
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG = {
+    'country': 'US',
+    'excludeHolidays': ['Columbus Day'],
+    'rules': [{
+        'description': 'Payday',
+        'dateStr': 'every 15th of the month'
+    }],
+    'customDates': {
+        '2018-07-02/2018-07-03': True,
+        '2018-07-04': False
+    }
+}
+
+
+class QueryTester(unittest.TestCase):
+
+    def test_describe(self):
+        provider = load_provider(CONFIG, date(2018, 7, 1), 30)
+
+        self.assertEqual(
+            dict(describe_date(provider, date(2018, 7, 4))), {
+                'date': '2018-07-04',
+                'day_off': 0,
+                'weekend': 0,
+                'holiday': 1,
+                'name': 'Independence Day'
+            })
+        self.assertEqual(describe_date(provider, date(2018, 7, 2))['day_off'],
+                         1)
+        self.assertEqual(describe_date(provider, date(2018, 8, 15))['name'],
+                         'Payday')
+        self.assertEqual(
+            describe_date(provider, date(2018, 10, 8))['day_off'], 0)
+
+    def test_years(self):
+        start = time.perf_counter()
+        provider = load_provider(CONFIG, date(2018, 1, 1), 3 * 366)
+        rows = [
+            describe_date(provider, date.fromordinal(ordinal))
+            for ordinal in range(date(2018, 1, 1).toordinal(),
+                                 date(2021, 1, 1).toordinal())
+        ]
+
+        self.assertLess(time.perf_counter() - start, 1)
+        self.assertEqual(len(rows), 1096)
+        self.assertEqual(sum('Payday' in (row['name'] or '') for row in rows),
+                         36)
+
+    def run_query(self, args, stdin=None, stderr=None):
+        with tempfile.TemporaryDirectory() as tmp:
+            config = os.path.join(tmp, 'config.json')
+            with open(config, 'w') as f:
+                json.dump(CONFIG, f)
+            return subprocess.run(
+                [sys.executable,
+                 os.path.join(ROOT, 'holidays_server.py'), 'query',
+                 '--config', config] + args,
+                input=stdin, cwd=tmp, stdout=subprocess.PIPE,
+                stderr=stderr or subprocess.DEVNULL, check=True,
+                universal_newlines=True).stdout.splitlines()
+
+    def test_csv_range(self):
+        lines = self.run_query(['--start', '2018-07-01', '--end', '2018-07-04'])
+
+        self.assertEqual(lines, [
+            'date,day_off,weekend,holiday,name', '2018-07-01,1,1,0,',
+            '2018-07-02,1,0,0,', '2018-07-03,1,0,0,',
+            '2018-07-04,0,0,1,Independence Day'
+        ])
+
+    def test_json_stdin(self):
+        lines = self.run_query(['--format', 'json'],
+                               stdin='2018-12-25\n\n2018-12-26\n')
+
+        self.assertEqual([json.loads(line) for line in lines], [{
+            'date': '2018-12-25',
+            'day_off': 1,
+            'weekend': 0,
+            'holiday': 1,
+            'name': 'Christmas Day'
+        }, {
+            'date': '2018-12-26',
+            'day_off': 0,
+            'weekend': 0,
+            'holiday': 0,
+            'name': None
+        }])
+
+    def test_malformed_stdin(self):
+        with tempfile.TemporaryFile('w+') as stderr:
+            lines = self.run_query(['--format', 'json'],
+                                   stdin='bad\n2018-12-25\n', stderr=stderr)
+            stderr.seek(0)
+            errors = stderr.read()
+
+        self.assertEqual([json.loads(line)['date'] for line in lines],
+                         ['2018-12-25'])
+        self.assertIn("Skipping line 1: 'bad'", errors)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,7 +3,10 @@ from datetime import datetime
 import udi_interface
 import sys
 import unittest
+from unittest.mock import patch
 
+from holidays_server import ParseCache
+from holidays_server import Recurrence
 from holidays_server import Rule
 
 sys.stdout = sys.__stdout__
@@ -110,5 +113,238 @@ class RuleTester(unittest.TestCase):
 
         self.assertEqual(RuleTester.rule.date, expected)
 
+
+class RuleCompilerTester(unittest.TestCase):
+
+    def test_evaluate_without_dateparser(self):
+        rule = Rule('every friday from Jan 1st to Dec 31st', 'Casual')
+        rule.compile()
+
+        with patch('dateparser.date.DateDataParser.get_date_data') as parse:
+            rule.parse(date(2018, 5, 25))
+            rule.parse(date(2018, 5, 26))
+
+        parse.assert_not_called()
+        self.assertEqual(rule.date, date(2018, 6, 1))
+
+    def test_weekly(self):
+        recurrence = Rule.compileRule('every wednesday')
+
+        self.assertEqual(recurrence.kind, Recurrence.WEEKLY)
+        self.assertEqual(recurrence.evaluate(date(2018, 5, 31)),
+                         date(2018, 6, 6))
+
+    def test_yearly_month_token(self):
+        recurrence = Rule.compileRule('every 5th of october')
+
+        self.assertEqual(recurrence.kind, Recurrence.YEARLY)
+        self.assertEqual(recurrence.evaluate(date(2018, 5, 25)),
+                         date(2018, 10, 5))
+
+    def test_monthly_year_end(self):
+        recurrence = Rule.compileRule('every 5th of the month')
+
+        self.assertEqual(recurrence.evaluate(date(2018, 12, 20)),
+                         date(2019, 1, 5))
+
+    def test_monthly_short_month(self):
+        recurrence = Rule.compileRule('every 31st of the month')
+
+        self.assertEqual(recurrence.evaluate(date(2019, 4, 5)),
+                         date(2019, 5, 31))
+
+    def test_to_date_next_year(self):
+        recurrence = Rule.compileRule('every 5th of november to January 31st')
+
+        self.assertEqual(recurrence.evaluate(date(2018, 12, 1)),
+                         date(2018, 11, 5))
+
+    def test_occurrences(self):
+        recurrence = Rule.compileRule('every 31st of the month')
+
+        self.assertEqual(
+            list(recurrence.occurrences(date(2018, 1, 1), date(2018, 6, 1))),
+            [date(2018, 1, 31), date(2018, 3, 31), date(2018, 5, 31)])
+
+    def test_occurrences_bounds(self):
+        recurrence = Rule.compileRule(
+            'every friday from June 1st 2018 to June 30th 2018')
+
+        self.assertEqual(
+            list(recurrence.occurrences(date(2018, 5, 1), date(2019, 1, 1))),
+            [date(2018, 6, 1), date(2018, 6, 8), date(2018, 6, 15),
+             date(2018, 6, 22), date(2018, 6, 29)])
+
+    def test_occurrences_lazy(self):
+        rule = Rule('every monday', 'Gym')
+        occurrences = rule.occurrences(date(2018, 1, 1), date(9999, 1, 1))
+
+        self.assertEqual(next(occurrences), date(2018, 1, 1))
+        self.assertEqual(next(occurrences), date(2018, 1, 8))
+
+    def test_day_of_month(self):
+        for day, ordinal in ((1, '1st'), (15, '15th'), (20, '20th'),
+                             (31, '31st')):
+            recurrence = Rule.compileRule('every ' + ordinal)
+
+            self.assertEqual(recurrence.kind, Recurrence.MONTHLY)
+            self.assertEqual(recurrence.day, day)
+
+    def test_every_weekday(self):
+        for weekday, name in enumerate(['monday', 'tuesday', 'wednesday',
+                                        'thursday', 'friday', 'saturday',
+                                        'sunday']):
+            recurrence = Rule.compileRule('every ' + name)
+
+            self.assertEqual(recurrence.kind, Recurrence.WEEKLY)
+            self.assertEqual(recurrence.weekday, weekday)
+
+    def test_relative_rejected(self):
+        for ruleStr in ('tomorrow', 'in 3 days', 'every tomorrow'):
+            with self.assertRaises(ValueError):
+                Rule.compileRule(ruleStr)
+
+        rule = Rule('tomorrow', 'Relative')
+        rule.parse(date(2018, 5, 25))
+        self.assertIsNone(rule.date)
+
+    def test_unparseable(self):
+        self.assertIsNone(Rule.compileRule('5th of november'))
+        with self.assertRaises(ValueError):
+            Rule.compileRule('every blah')
+
+
+class RuleCompileAllTester(unittest.TestCase):
+
+    RULES = ['every friday', 'every blah', 'every 5th of the month',
+             'every May 15']
+
+    def assertCompiled(self, rules):
+        self.assertEqual([rule.compiled for rule in rules], [True] * 4)
+        self.assertEqual(rules[0].recurrence.kind, Recurrence.WEEKLY)
+        self.assertIsNone(rules[1].recurrence)
+        self.assertEqual(rules[2].recurrence.day, 5)
+        self.assertEqual(rules[3].recurrence.kind, Recurrence.YEARLY)
+
+    def test_serial(self):
+        rules = [Rule(rule, 'Rule') for rule in self.RULES]
+        with patch('holidays_server.ProcessPoolExecutor') as pool:
+            Rule.compileAll(rules)
+
+        pool.assert_not_called()
+        self.assertCompiled(rules)
+
+    def test_single_cpu(self):
+        rules = [Rule(rule, 'Rule') for rule in self.RULES]
+        with patch.object(Rule, 'POOL_THRESHOLD', 2), \
+                patch('holidays_server.os.cpu_count', return_value=1), \
+                patch('holidays_server.ProcessPoolExecutor') as pool:
+            Rule.compileAll(rules)
+
+        pool.assert_not_called()
+        self.assertCompiled(rules)
+
+    def test_pool(self):
+        rules = [Rule(rule, 'Rule') for rule in self.RULES]
+        with patch.object(Rule, 'POOL_THRESHOLD', 2), \
+                patch('holidays_server.os.cpu_count', return_value=2):
+            Rule.compileAll(rules)
+
+        self.assertCompiled(rules)
+
+    def test_pool_failure(self):
+        rules = [Rule(rule, 'Rule') for rule in self.RULES]
+        with patch.object(Rule, 'POOL_THRESHOLD', 2), \
+                patch('holidays_server.os.cpu_count', return_value=2), \
+                patch('holidays_server.ProcessPoolExecutor') as pool, \
+                self.assertLogs(udi_interface.LOGGER, 'WARNING'):
+            pool.return_value.__enter__.return_value.map.side_effect = \
+                TypeError('cannot pickle')
+            Rule.compileAll(rules)
+
+        self.assertCompiled(rules)
+
+    def test_error_isolated(self):
+        rule = Rule('every blah', 'Broken')
+        rule.parse(date(2018, 5, 25))
+
+        self.assertTrue(rule.compiled)
+        self.assertIsNone(rule.date)
+        self.assertEqual(list(rule.occurrences(date(2018, 1, 1),
+                                               date(2019, 1, 1))), [])
+
+
+class ParseCacheTester(unittest.TestCase):
+
+    def test_hit(self):
+        cache = ParseCache()
+        base = datetime(2018, 5, 25)
+        first = cache.parse('May 15', {'RELATIVE_BASE': base})
+        second = cache.parse(' may  15 ',
+                             {'RELATIVE_BASE': datetime(2018, 5, 25, 13)})
+
+        self.assertEqual(first, datetime(2018, 5, 15))
+        self.assertEqual(first, second)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_settings_in_key(self):
+        cache = ParseCache()
+        base = datetime(2018, 5, 25)
+        cache.parse('January 31st', {'RELATIVE_BASE': base})
+        future = cache.parse('January 31st', {
+            'RELATIVE_BASE': base,
+            'PREFER_DATES_FROM': 'future'
+        })
+
+        self.assertEqual(future, datetime(2019, 1, 31))
+        self.assertEqual(cache.misses, 2)
+
+    def test_eviction(self):
+        cache = ParseCache(size=2)
+        with patch.object(cache, 'get_parser') as get_parser:
+            cache.parse('monday')
+            cache.parse('tuesday')
+            cache.parse('monday')
+            cache.parse('wednesday')
+            cache.parse('tuesday')
+
+        self.assertEqual(get_parser.return_value.get_date_data.call_count, 4)
+        self.assertEqual(len(cache.entries), 2)
+        self.assertEqual(cache.hits, 1)
+
+    def test_parser_reused(self):
+        cache = ParseCache()
+        base = datetime(2018, 5, 25)
+        cache.parse('May 15', {'RELATIVE_BASE': base})
+        parser = cache.get_parser({'RELATIVE_BASE': base})
+        cache.parse('June 15', {'RELATIVE_BASE': base})
+
+        self.assertEqual(len(cache.parsers), 1)
+        self.assertIs(cache.get_parser({'RELATIVE_BASE': base}), parser)
+
+    def test_languages(self):
+        cache = ParseCache(languages=['de'])
+        base = datetime(2018, 5, 25)
+
+        self.assertEqual(cache.parse('15. Mai', {'RELATIVE_BASE': base}),
+                         datetime(2018, 5, 15))
+        self.assertFalse(cache.set_languages(['de']))
+        self.assertTrue(cache.set_languages(['en']))
+        self.assertEqual(len(cache.entries), 0)
+        self.assertIsNone(cache.parse('15. Mai', {'RELATIVE_BASE': base}))
+
+    def test_check_languages(self):
+        with self.assertLogs(udi_interface.LOGGER, 'WARNING') as logs:
+            self.assertEqual(ParseCache.check_languages(['english', 'de']),
+                             ['de'])
+        self.assertIn('english', logs.output[0])
+
+        with self.assertLogs(udi_interface.LOGGER, 'WARNING'):
+            self.assertEqual(ParseCache.check_languages(['english']),
+                             list(ParseCache.DEFAULT_LANGUAGES))
+        self.assertEqual(ParseCache.check_languages(None),
+                         list(ParseCache.DEFAULT_LANGUAGES))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,46 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Importing the node server and constructing the controller's provider must
+# not pull in dateparser or holidays, and should stay well under this budget.
+IMPORT_BUDGET = 1.5
+
+SCRIPT = '''
+import json
+import sys
+import time
+start = time.perf_counter()
+import holidays_server
+elapsed = time.perf_counter() - start
+holidays_server.DateProvider('US').refresh()
+print(json.dumps({
+    'elapsed': elapsed,
+    'dateparser': 'dateparser' in sys.modules,
+    'holidays': 'holidays' in sys.modules,
+}))
+'''
+
+
+class StartupTester(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        output = subprocess.check_output([sys.executable, '-c', SCRIPT],
+                                         cwd=ROOT)
+        cls.result = json.loads(output.decode().strip().splitlines()[-1])
+
+    def test_lazy_imports(self):
+        self.assertFalse(self.result['dateparser'])
+        self.assertFalse(self.result['holidays'])
+
+    def test_import_time(self):
+        self.assertLess(self.result['elapsed'], IMPORT_BUDGET)
+
+
+if __name__ == '__main__':
+    unittest.main()